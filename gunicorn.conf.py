@@ -0,0 +1,8 @@
+# gunicorn.conf.py — gunicorn подхватывает этот файл из текущей папки автоматически
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# потоковые воркеры: пока один поток ждёт ответа Telegram на send_photo, другие обслуживают запросы
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
@@ -1,8 +1,34 @@
 # main.py
-import os, base64, uuid, traceback
-from flask import Flask, request, send_from_directory, jsonify
+import os, base64, gzip, json, threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+from secrets import token_urlsafe
+from flask import Flask, Response, request, send_file, send_from_directory, jsonify
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import generate_etag
 
 try:
+    # pybase64 — векторизованный (SIMD) декодер, заметно быстрее stdlib на больших PNG
+    import pybase64
+    _b64decode = pybase64.b64decode
+except ImportError:
+    _b64decode = base64.b64decode
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
+
+try:
+    from whitenoise import WhiteNoise
+except ImportError:
+    WhiteNoise = None
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
     import telebot
     from telebot import types
 except Exception:
@@ -11,51 +37,201 @@ except Exception:
 
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # e.g. https://your-service.onrender.com
+# базовый URL приложения — сначала берем WEBHOOK_URL, потом WEBAPP_URL, потом fallback (заменяй если нужно)
+BASE_URL = (WEBHOOK_URL or os.getenv('WEBAPP_URL') or 'https://telegram-draw-bot-wxuc.onrender.com').rstrip('/')
+
 app = Flask(__name__, static_folder='static')
+# папку загрузок привязываем к каталогу приложения, а не к текущей рабочей папке
+UPLOADS_DIR = os.path.join(app.root_path, 'static', 'uploads')
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+_UPLOADS_PREFIX = UPLOADS_DIR + os.sep
+
+INDEX_PATH = os.path.join(app.static_folder, 'index.html')
+_index_gz = (None, b'', '')  # (mtime_ns, gzip-тело, etag)
+# Flask сам отвечает 413 на тело больше лимита, ещё до декодирования base64
+app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024
+if orjson:
+    class OrjsonProvider(DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+if WhiteNoise:
+    # статику (/static/...) отдаёт WhiteNoise с кэш-заголовками, не доходя до Flask.
+    # Файлы, появившиеся после старта (новые uploads), WhiteNoise не знает — их подхватит static-роут Flask.
+    app.wsgi_app = WhiteNoise(app.wsgi_app, root=app.static_folder, prefix='static/', max_age=3600)
 bot = telebot.TeleBot(TOKEN) if (telebot and TOKEN) else None
+if bot:
+    # одна общая сессия с пулом keep-alive соединений к api.telegram.org на все потоки воркера,
+    # чтобы send_photo не делал TLS-рукопожатие заново
+    _tg_session = requests.Session()
+    _tg_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=50))
+    telebot.apihelper.session = _tg_session
+    telebot.apihelper.CONNECT_TIMEOUT = 5
+
+# отправка в Telegram идёт в фоне: клиенту отвечаем сразу после записи файла.
+# Очередь ограничена: если Telegram тормозит и все слоты заняты, отвечаем 503, а не копим задачи
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+SEND_SLOTS = threading.BoundedSemaphore(32)
+
+@app.errorhandler(RequestEntityTooLarge)
+def too_large(e):
+    return jsonify({'error': 'too large'}), 413
+
+def _index_gzip():
+    """gzip-копия index.html с готовым ETag; пересжимаем, только если файл изменился."""
+    global _index_gz
+    mtime = os.stat(INDEX_PATH).st_mtime_ns
+    if _index_gz[0] != mtime:
+        with open(INDEX_PATH, 'rb') as f:
+            body = gzip.compress(f.read(), 9)
+        _index_gz = (mtime, body, generate_etag(body))
+    return _index_gz
 
 @app.route('/')
 def index():
-    return send_from_directory('static', 'index.html')
+    gz = None
+    if request.accept_encodings['gzip']:
+        try:
+            gz = _index_gzip()
+        except OSError:
+            pass  # файла нет — send_from_directory ниже ответит 404
+    if gz:
+        resp = Response(gz[1], mimetype='text/html')
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag(gz[2])
+        resp.make_conditional(request)
+    else:
+        # send_from_directory отдаёт файл через wsgi.file_wrapper — gunicorn сам делает sendfile(2)
+        resp = send_from_directory('static', 'index.html')
+    resp.vary.add('Accept-Encoding')
+    return resp
 
-@app.route('/upload', methods=['POST'])
-def upload():
-    data = request.get_json(force=True)
-    if not data or 'image' not in data:
-        return jsonify({'error': 'no image'}), 400
+# всё, что не входит в алфавит base64: декодер с validate=False такие байты просто выбрасывает
+_B64_JUNK = bytes(set(range(256)) - set(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='))
 
-    img_b64 = data['image']
-    header, b64 = img_b64.split(',', 1) if ',' in img_b64 else ('', img_b64)
-    try:
-        img_data = base64.b64decode(b64)
-    except Exception as e:
-        return jsonify({'error': 'bad base64', 'detail': str(e)}), 400
+def _save_b64_stream(stream, filepath, chunk_size=64 * 1024):
+    """Декодирует base64 из потока кусками прямо в файл, возвращает число записанных байт.
 
-    os.makedirs(os.path.join('static', 'uploads'), exist_ok=True)
-    filename = f"{uuid.uuid4().hex}.png"
-    filepath = os.path.join('static', 'uploads', filename)
+    Принимает и data-URL целиком (так шлёт canvas.toDataURL() из static/index.html), и голый base64,
+    в том числе с переносами строк (вывод `base64` CLI / base64.encodebytes). Обрезанный ввод
+    (без паддинга) даёт ошибку, как и в JSON-ветке.
+    """
+    written = 0
+    carry = b''
+    first = True
     with open(filepath, 'wb') as f:
-        f.write(img_data)
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            if first:
+                first = False
+                comma = chunk.find(b',', 0, 64)
+                if comma != -1:
+                    chunk = chunk[comma + 1:]
+            # мусор (пробелы, переносы и пр.) декодер всё равно выбросит — убираем его до выравнивания,
+            # иначе оно собьётся
+            chunk = carry + chunk.translate(None, _B64_JUNK)
+            # декодируем только кратное 4 количество символов, остаток переносим в следующий кусок
+            cut = len(chunk) - len(chunk) % 4
+            carry = chunk[cut:]
+            written += f.write(_b64decode(chunk[:cut], validate=False))
+        if carry:
+            # хвост не дополняем '=': неполная четвёрка — это обрезанный ввод, пусть декодер ругнётся
+            written += f.write(_b64decode(carry, validate=False))
+    return written
 
-    chat_id = data.get('chat_id')
-    if bot and chat_id:
+def _send_to_telegram(chat_id, filepath):
+    """Фоновая отправка рисунка; ошибки вернуть клиенту уже нельзя, поэтому только логируем."""
+    try:
+        # в задаче держим только путь — файл читаем здесь (обычно из page cache), а не храним PNG в очереди
+        with open(filepath, 'rb') as p:
+            bot.send_photo(chat_id, p)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        SEND_SLOTS.release()
+
+def _write_file(filepath, data):
+    """Пишет готовый bytes одним os.write, минуя буфер BufferedWriter."""
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+@app.route('/upload', methods=['POST'])
+def upload():
+    filename = token_urlsafe(12) + '.png'
+    filepath = _UPLOADS_PREFIX + filename
+
+    if request.mimetype == 'application/base64':
+        # сырое тело base64 + chat_id в query string: пишем на диск потоково, без копии всего PNG в памяти
+        chat_id = request.args.get('chat_id')
+        try:
+            written = _save_b64_stream(request.stream, filepath)
+        except Exception as e:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            if isinstance(e, RequestEntityTooLarge):
+                raise
+            return jsonify({'error': 'bad base64', 'detail': str(e)}), 400
+        if not written:
+            os.remove(filepath)
+            return jsonify({'error': 'no image'}), 400
+    else:
+        try:
+            data = _json_loads(request.get_data(cache=False))
+        except ValueError:
+            return jsonify({'error': 'bad json'}), 400
+        if not isinstance(data, dict) or 'image' not in data:
+            return jsonify({'error': 'no image'}), 400
+
+        img_b64 = data['image']
+        if not isinstance(img_b64, str):
+            return jsonify({'error': 'no image'}), 400
+        # запятая data-URL всегда в первых байтах — не сканируем весь многомегабайтный payload
+        comma = img_b64.find(',', 0, 64)
+        if comma != -1:
+            img_b64 = img_b64[comma + 1:]
         try:
-            with open(filepath, 'rb') as p:
-                bot.send_photo(chat_id, p)
-            return jsonify({'status': 'sent', 'file': f'/static/uploads/{filename}'}), 201
+            img_data = _b64decode(img_b64, validate=False)
         except Exception as e:
-            return jsonify({'status': 'error_sending', 'detail': str(e)}), 500
+            return jsonify({'error': 'bad base64', 'detail': str(e)}), 400
+
+        _write_file(filepath, img_data)
+        chat_id = data.get('chat_id')
+
+    if bot and chat_id:
+        if SEND_SLOTS.acquire(blocking=False):
+            try:
+                EXECUTOR.submit(_send_to_telegram, chat_id, filepath)
+                return jsonify({'status': 'queued', 'file': f'/static/uploads/{filename}'}), 202
+            except RuntimeError:
+                # executor уже остановлен (graceful restart) — слот возвращаем сами, воркер его не освободит
+                SEND_SLOTS.release()
+        # файл уже сохранён и доступен по 'file' — повторять загрузку не нужно
+        return jsonify({'status': 'busy', 'file': f'/static/uploads/{filename}',
+                        'detail': 'saved but not sent to Telegram; file URL is valid, do not re-upload'}), 503
 
+    if request.args.get('return_image', type=int):
+        # отдаём сохранённый PNG сразу в ответе — через wsgi.file_wrapper, т.е. sendfile(2) под gunicorn
+        return send_file(filepath, mimetype='image/png'), 201
     return jsonify({'status': 'saved', 'file': f'/static/uploads/{filename}'}), 201
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    """Telegram POSTs updates here. We must pass the raw JSON string into de_json."""
+    """Telegram POSTs updates here. The body is parsed straight from bytes and de_json gets a dict."""
     if not bot:
         return 'no bot token configured', 400
     try:
-        raw = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(raw)
+        update = telebot.types.Update.de_json(_json_loads(request.get_data(cache=False)))
         bot.process_new_updates([update])
         return '', 200
     except Exception:
@@ -67,11 +243,7 @@ if bot:
     @bot.message_handler(commands=['start'])
     def handle_start(message):
         chat_id = message.chat.id
-        # базовый URL приложения — сначала берем WEBHOOK_URL, потом WEBAPP_URL, потом fallback
-        base = WEBHOOK_URL or os.getenv('WEBAPP_URL') or ''
-        if not base:
-            base = 'https://telegram-draw-bot-wxuc.onrender.com'  # заменяй если нужно
-        url = base.rstrip('/') + f'/?chat_id={chat_id}'
+        url = f'{BASE_URL}/?chat_id={chat_id}'
 
         kb = types.InlineKeyboardMarkup()
         # Используем WebAppInfo, чтобы Telegram открыл Web App внутри клиента (если поддерживается)